@@ -1,7 +1,8 @@
 import asyncio
+import collections
 import logging
 import os
-import queue
+import re
 import tempfile
 import time
 
@@ -11,6 +12,7 @@ from telegram.ext import Application, CommandHandler, MessageHandler, filters, C
 from config import Config
 from session_store import SessionStore
 from claude_runner import ClaudeRunner, ToolEvent
+from keyed_lock import KeyedLockPool
 from message_sender import MessageSender
 
 Config.validate()
@@ -25,14 +27,23 @@ runner = ClaudeRunner(
     system_prompt=Config.CLAUDE_SYSTEM_PROMPT,
 )
 
-# Per-user locks to serialize concurrent messages
-_user_locks: dict[int, asyncio.Lock] = {}
+# Caps how many claude processes run at once, so bursts can't fork without bound
+_claude_slots = asyncio.Semaphore(Config.MAX_CONCURRENT_CLAUDE)
 
+# Where incoming photos/documents are saved before being handed to Claude
+_TMP_DIR = os.path.join(tempfile.gettempdir(), "phone-bridge")
+os.makedirs(_TMP_DIR, exist_ok=True)
 
-def _get_user_lock(user_id: int) -> asyncio.Lock:
-    if user_id not in _user_locks:
-        _user_locks[user_id] = asyncio.Lock()
-    return _user_locks[user_id]
+# Local download names are built from Telegram-supplied values; keep them filesystem-safe
+_UNSAFE_NAME_CHARS = re.compile(r"[^A-Za-z0-9_-]")
+_SAFE_EXT = re.compile(r"\.[A-Za-z0-9]{1,10}")
+
+# Per-user locks: one serializes Claude runs, the other keeps replies in order
+_user_locks = KeyedLockPool()
+_send_locks = KeyedLockPool()
+
+# Seconds between SQLite WAL checkpoints (see SessionStore.maintenance)
+DB_MAINTENANCE_INTERVAL = 15 * 60
 
 
 def _is_allowed(user_id: int) -> bool:
@@ -42,41 +53,46 @@ def _is_allowed(user_id: int) -> bool:
     return user_id in Config.ALLOWED_USERS
 
 
+START_TEMPLATE = (
+    "Phone Bridge is running.\n\n"
+    "Your user ID: {uid}\n"
+    "Add this to ALLOWED_USERS in .env to lock down access.\n\n"
+    "Send any message to talk to Claude Code.\n"
+    "Commands: /reset /status /more /help"
+)
+
+HELP_TEXT = (
+    "Commands:\n"
+    "/reset — Start a new session\n"
+    "/status — Show current session info\n"
+    "/more — Get truncated content\n"
+    "/cost — Show cumulative session cost\n"
+    "/prompt — View or set system prompt\n"
+    "/chrome — Toggle Chrome browser control\n"
+    "/timeout — Kill active Claude process\n"
+    "/help — Show this message\n\n"
+    "You can also send photos and files.\n"
+    "Anything else is sent to Claude Code."
+)
+
+
 async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    logger.info(f"/start from user {user.id} ({user.username})")
-    await update.message.reply_text(
-        f"Phone Bridge is running.\n\n"
-        f"Your user ID: {user.id}\n"
-        f"Add this to ALLOWED_USERS in .env to lock down access.\n\n"
-        f"Send any message to talk to Claude Code.\n"
-        f"Commands: /reset /status /more /help"
-    )
+    logger.info("/start from user %s (%s)", user.id, user.username)
+    await update.message.reply_text(START_TEMPLATE.format(uid=user.id))
 
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not _is_allowed(update.effective_user.id):
         return
-    await update.message.reply_text(
-        "Commands:\n"
-        "/reset — Start a new session\n"
-        "/status — Show current session info\n"
-        "/more — Get truncated content\n"
-        "/cost — Show cumulative session cost\n"
-        "/prompt — View or set system prompt\n"
-        "/chrome — Toggle Chrome browser control\n"
-        "/timeout — Kill active Claude process\n"
-        "/help — Show this message\n\n"
-        "You can also send photos and files.\n"
-        "Anything else is sent to Claude Code."
-    )
+    await update.message.reply_text(HELP_TEXT)
 
 
 async def cmd_reset(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not _is_allowed(user_id):
         return
-    store.reset_session(str(user_id))
+    await store.areset_session(str(user_id))
     await update.message.reply_text("Session reset. Next message starts a fresh conversation.")
 
 
@@ -84,9 +100,9 @@ async def cmd_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not _is_allowed(user_id):
         return
-    session_id = store.get_session(str(user_id))
-    info = store.list_sessions()
-    entry = next((s for s in info if s["phone_number"] == str(user_id)), None)
+    uid = str(user_id)
+    session_id = await store.aget_session(uid)
+    entry = await store.aget_session_info(uid)
     lines = [
         f"Session: {session_id or 'none'}",
         f"Dir: {Config.CLAUDE_WORKING_DIR}",
@@ -102,9 +118,9 @@ async def cmd_cost(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not _is_allowed(user_id):
         return
-    total = store.get_cost(str(user_id))
-    info = store.list_sessions()
-    entry = next((s for s in info if s["phone_number"] == str(user_id)), None)
+    uid = str(user_id)
+    total = await store.aget_cost(uid)
+    entry = await store.aget_session_info(uid)
     msg_count = entry["message_count"] if entry else 0
     await update.message.reply_text(
         f"Session cost: ${total:.4f}\n"
@@ -156,44 +172,58 @@ async def cmd_more(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("No more content to send.")
 
 
-async def _download_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str | None:
-    """Download a photo or document from the message. Returns the local path or None."""
+async def _download_files(update: Update, context: ContextTypes.DEFAULT_TYPE) -> list[str]:
+    """Download the photos/documents on the message concurrently. Returns the local paths."""
     msg = update.message
 
+    attachments: list[tuple[str, str]] = []  # (file_id, ext)
     if msg.photo:
         # Get the highest-resolution photo
-        photo = msg.photo[-1]
-        file = await context.bot.get_file(photo.file_id)
-        ext = ".jpg"
-    elif msg.document:
-        file = await context.bot.get_file(msg.document.file_id)
-        name = msg.document.file_name or "file"
-        ext = os.path.splitext(name)[1] or ""
-    else:
-        return None
+        attachments.append((msg.photo[-1].file_id, ".jpg"))
+    if msg.document:
+        ext = os.path.splitext(msg.document.file_name or "")[1]
+        attachments.append((msg.document.file_id, ext if _SAFE_EXT.fullmatch(ext) else ""))
+
+    async def fetch(file_id: str, ext: str) -> str:
+        file = await context.bot.get_file(file_id)
+        stem = _UNSAFE_NAME_CHARS.sub("_", file.file_unique_id)
+        local_path = os.path.join(_TMP_DIR, f"{stem}{ext}")
+        await file.download_to_drive(local_path)
+        logger.info("Downloaded file to %s", local_path)
+        return local_path
 
-    tmp_dir = os.path.join(tempfile.gettempdir(), "phone-bridge")
-    os.makedirs(tmp_dir, exist_ok=True)
-    local_path = os.path.join(tmp_dir, f"{file.file_unique_id}{ext}")
-    await file.download_to_drive(local_path)
-    logger.info(f"Downloaded file to {local_path}")
-    return local_path
+    return list(await asyncio.gather(*(fetch(file_id, ext) for file_id, ext in attachments)))
 
 
 IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"}
 
 
-async def _deliver_outbox(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
-    """Send any files in the outbox to the user, then delete them."""
+def _take_outbox() -> str | None:
+    """Move the files currently in the outbox into a private staging dir and return it.
+
+    Called while the user's run lock is held, so only files from the run that just
+    finished are taken; the next run can write to the outbox while these are sent.
+    Returns None if there is nothing to send.
+    """
     outbox = Config.OUTBOX_DIR
     if not os.path.isdir(outbox):
-        return
+        return None
 
-    for filename in sorted(os.listdir(outbox)):
-        filepath = os.path.join(outbox, filename)
-        if not os.path.isfile(filepath):
-            continue
+    names = [name for name in sorted(os.listdir(outbox)) if os.path.isfile(os.path.join(outbox, name))]
+    if not names:
+        return None
 
+    # Inside the outbox so the moves stay on one filesystem; later scans skip directories
+    staging = tempfile.mkdtemp(prefix=".sending-", dir=outbox)
+    for name in names:
+        os.replace(os.path.join(outbox, name), os.path.join(staging, name))
+    return staging
+
+
+async def _deliver_outbox(context: ContextTypes.DEFAULT_TYPE, chat_id: int, staging: str):
+    """Send the files taken by _take_outbox to the user, then delete them."""
+    for filename in sorted(os.listdir(staging)):
+        filepath = os.path.join(staging, filename)
         try:
             ext = os.path.splitext(filename)[1].lower()
             if ext in IMAGE_EXTENSIONS:
@@ -201,20 +231,38 @@ async def _deliver_outbox(context: ContextTypes.DEFAULT_TYPE, chat_id: int):
             else:
                 await context.bot.send_document(chat_id=chat_id, document=open(filepath, "rb"), filename=filename)
             os.remove(filepath)
-            logger.info(f"Delivered outbox file: {filename}")
+            logger.info("Delivered outbox file: %s", filename)
         except Exception:
-            logger.exception(f"Failed to deliver outbox file: {filename}")
-
-
-def _format_status(elapsed: int, tool_calls: list[str]) -> str:
+            logger.exception("Failed to deliver outbox file: %s", filename)
+
+    # Put back anything that failed so the next reply retries it, as before
+    for filename in os.listdir(staging):
+        dest = os.path.join(Config.OUTBOX_DIR, filename)
+        if not os.path.exists(dest):
+            os.replace(os.path.join(staging, filename), dest)
+    try:
+        os.rmdir(staging)
+    except OSError:
+        logger.warning("Left undelivered files in %s", staging)
+
+
+# Number of recent tool calls shown in the status message
+STATUS_TOOL_LINES = 5
+# Minimum seconds between status message edits (Telegram throttles rapid edits)
+STATUS_EDIT_INTERVAL = 1.0
+# Telegram shows "typing" for ~5s per chat action; refresh a little before it lapses
+TYPING_INTERVAL = 4.0
+# Skip the typing indicator if the status message was edited this recently
+TYPING_SKIP_WINDOW = 4.5
+
+
+def _format_status(elapsed: int, recent: collections.deque[str]) -> str:
     """Format the live status message showing elapsed time and recent tool calls."""
     lines = [f"Working... ({elapsed}s)"]
-    if tool_calls:
-        # Show last 5 tool calls
-        recent = tool_calls[-5:]
-        for i, tc in enumerate(recent):
-            prefix = ">" if i == len(recent) - 1 else " "
-            lines.append(f"{prefix} {tc}")
+    last = len(recent) - 1
+    for i, tc in enumerate(recent):
+        prefix = ">" if i == last else " "
+        lines.append(f"{prefix} {tc}")
     return "\n".join(lines)
 
 
@@ -226,57 +274,72 @@ async def _process_message(
 ):
     """Core message processing: stream Claude tool calls live, then send reply."""
     user_id = update.effective_user.id
+    uid = str(user_id)
     sender: MessageSender = context.bot_data["sender"]
 
-    lock = _get_user_lock(user_id)
-    async with lock:
-        try:
-            session_id = store.get_session(str(user_id))
+    try:
+        async with _user_locks.lock(user_id):
+            session_id = await store.aget_session(uid)
 
             status_msg = await context.bot.send_message(
                 chat_id=user_id, text="Working..."
             )
             start_time = time.monotonic()
             done_event = asyncio.Event()
-            event_queue: queue.Queue[ToolEvent] = queue.Queue()
-            tool_calls: list[str] = []
+            tool_event = asyncio.Event()  # set when a tool call arrives
+            # Only the last few tool calls are shown; the runner keeps the full list
+            tool_calls: collections.deque[str] = collections.deque(maxlen=STATUS_TOOL_LINES)
             last_status_text = ""
+            last_edit_attempt_ts = 0.0  # when a status edit was last tried (debounce)
+            last_edit_ts = 0.0  # when a status edit last went through (typing skip)
+
+            def on_tool(evt: ToolEvent):
+                tool_calls.append(evt.summary)
+                tool_event.set()
 
             async def update_status():
-                """Poll the event queue and update the status message with tool calls."""
-                nonlocal last_status_text
+                """Update the status message as tool calls arrive, ticking the timer in between."""
+                nonlocal last_status_text, last_edit_attempt_ts, last_edit_ts
                 while not done_event.is_set():
-                    # Drain all pending events
-                    while True:
+                    # Wake on the next tool call, or after a few seconds to refresh the timer
+                    try:
+                        await asyncio.wait_for(tool_event.wait(), timeout=3)
+                    except asyncio.TimeoutError:
+                        pass
+                    # Hold off until the minimum edit interval has passed; calls that
+                    # arrive meanwhile are folded into the same edit
+                    wait = STATUS_EDIT_INTERVAL - (time.monotonic() - last_edit_attempt_ts)
+                    if wait > 0:
                         try:
-                            evt = event_queue.get_nowait()
-                            tool_calls.append(evt.summary)
-                        except queue.Empty:
-                            break
+                            await asyncio.wait_for(done_event.wait(), timeout=wait)
+                        except asyncio.TimeoutError:
+                            pass
+                    if done_event.is_set():
+                        break
+                    tool_event.clear()
 
                     elapsed = int(time.monotonic() - start_time)
                     new_text = _format_status(elapsed, tool_calls)
 
                     if new_text != last_status_text:
+                        last_edit_attempt_ts = time.monotonic()
                         try:
                             await status_msg.edit_text(new_text)
                             last_status_text = new_text
+                            last_edit_ts = time.monotonic()
                         except Exception:
                             pass
 
-                    try:
-                        await asyncio.wait_for(done_event.wait(), timeout=3)
-                    except asyncio.TimeoutError:
-                        pass
-
             async def keep_typing():
                 while not done_event.is_set():
+                    # A status edit that just went out already shows activity
+                    if time.monotonic() - last_edit_ts >= TYPING_SKIP_WINDOW:
+                        try:
+                            await context.bot.send_chat_action(chat_id=user_id, action="typing")
+                        except Exception:
+                            pass
                     try:
-                        await context.bot.send_chat_action(chat_id=user_id, action="typing")
-                    except Exception:
-                        pass
-                    try:
-                        await asyncio.wait_for(done_event.wait(), timeout=5)
+                        await asyncio.wait_for(done_event.wait(), timeout=TYPING_INTERVAL)
                     except asyncio.TimeoutError:
                         pass
 
@@ -284,44 +347,57 @@ async def _process_message(
             typing_task = asyncio.create_task(keep_typing())
 
             try:
-                result = await asyncio.to_thread(
-                    runner.run_streaming,
-                    prompt=body,
-                    session_id=session_id,
-                    file_paths=file_paths,
-                    event_queue=event_queue,
-                )
+                async with _claude_slots:
+                    result = await runner.run_streaming(
+                        prompt=body,
+                        session_id=session_id,
+                        file_paths=file_paths,
+                        on_tool=on_tool,
+                    )
             finally:
                 done_event.set()
-                await status_task
-                await typing_task
-
-            # Delete the status message
+                tool_event.set()  # wake update_status
+                typing_task.cancel()
+                await asyncio.gather(status_task, typing_task, return_exceptions=True)
+
+            # A failed run that cost nothing and left the session where it was has
+            # nothing to record; skip the write
+            if result.cost_usd or not result.is_error or result.session_id != (session_id or ""):
+                await store.asave_session(uid, result.session_id, Config.CLAUDE_WORKING_DIR, result.cost_usd)
+
+            # Claim this run's outbox files before the next run can add to the outbox
+            staging = _take_outbox()
+
+        text = result.text
+        elapsed = round(time.monotonic() - start_time, 1)
+        if result.cost_usd > 0:
+            text += f"\n\n[${result.cost_usd:.4f} | {elapsed}s | {len(result.tool_calls)} tool calls]"
+
+        # Deliver the reply outside the run lock so the user's next message can
+        # start Claude meanwhile. The send lock is taken without yielding after
+        # the run lock is released, so replies still go out in order.
+        async with _send_locks.lock(user_id):
             try:
-                await status_msg.delete()
-            except Exception:
-                pass
-
-            store.save_session(str(user_id), result.session_id, Config.CLAUDE_WORKING_DIR, result.cost_usd)
+                # Delete the status message
+                try:
+                    await status_msg.delete()
+                except Exception:
+                    pass
 
-            text = result.text
-            elapsed = round(time.monotonic() - start_time, 1)
-            if result.cost_usd > 0:
-                text += f"\n\n[${result.cost_usd:.4f} | {elapsed}s | {len(result.tool_calls)} tool calls]"
-
-            await sender.send(user_id, text)
-
-            # Deliver any files from the outbox
-            await _deliver_outbox(context, user_id)
+                await sender.send(user_id, text)
+            finally:
+                # Deliver the files this run left in the outbox
+                if staging:
+                    await _deliver_outbox(context, user_id, staging)
 
+    except Exception:
+        logger.exception("Error processing message from %s", user_id)
+        try:
+            await update.message.reply_text(
+                "Something went wrong processing your message. Check server logs."
+            )
         except Exception:
-            logger.exception(f"Error processing message from {user_id}")
-            try:
-                await update.message.reply_text(
-                    "Something went wrong processing your message. Check server logs."
-                )
-            except Exception:
-                logger.exception("Failed to send error reply")
+            logger.exception("Failed to send error reply")
 
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -329,33 +405,55 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     body = (update.message.text or "").strip()
 
     if not _is_allowed(user_id):
-        logger.warning(f"Blocked message from user {user_id}")
+        logger.warning("Blocked message from user %s", user_id)
         return
 
-    logger.info(f"Message from {user_id}: {body[:80]!r}")
+    logger.info("Message from %s: %r", user_id, body[:80])
     await _process_message(update, context, body)
 
 
 async def handle_photo_or_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if not _is_allowed(user_id):
-        logger.warning(f"Blocked file from user {user_id}")
+        logger.warning("Blocked file from user %s", user_id)
         return
 
     caption = (update.message.caption or "").strip()
-    file_path = await _download_file(update, context)
-    if not file_path:
+    file_paths = await _download_files(update, context)
+    if not file_paths:
         await update.message.reply_text("Unsupported file type.")
         return
 
-    # Build prompt: include caption if provided, and tell Claude about the file
+    # Build prompt: include caption if provided, and tell Claude about the files
+    attached = "\n".join(f"[Attached file: {path}]" for path in file_paths)
     if caption:
-        body = f"{caption}\n\n[Attached file: {file_path}]"
+        body = f"{caption}\n\n{attached}"
     else:
-        body = f"I've sent you a file. Please look at it and describe what you see.\n\n[Attached file: {file_path}]"
+        body = f"I've sent you a file. Please look at it and describe what you see.\n\n{attached}"
+
+    logger.info("Files from %s: %s caption=%r", user_id, file_paths, caption[:80])
+    await _process_message(update, context, body, file_paths=file_paths)
 
-    logger.info(f"File from {user_id}: {file_path} caption={caption[:80]!r}")
-    await _process_message(update, context, body, file_paths=[file_path])
+
+async def _db_maintenance_loop():
+    while True:
+        await asyncio.sleep(DB_MAINTENANCE_INTERVAL)
+        try:
+            await store.amaintenance()
+        except Exception:
+            logger.exception("Session DB maintenance failed")
+
+
+async def _post_init(app: Application):
+    app.bot_data["db_maintenance"] = asyncio.create_task(_db_maintenance_loop())
+
+
+async def _post_shutdown(app: Application):
+    task = app.bot_data.pop("db_maintenance", None)
+    if task:
+        task.cancel()
+    # Leave a truncated WAL behind on a clean exit
+    await store.amaintenance()
 
 
 def main():
@@ -367,11 +465,17 @@ def main():
     logger.info(f"Claude working dir: {Config.CLAUDE_WORKING_DIR}")
     logger.info(f"Allowed tools: {Config.CLAUDE_ALLOWED_TOOLS}")
     if Config.ALLOWED_USERS:
-        logger.info(f"Allowed users: {Config.ALLOWED_USERS}")
+        logger.info(f"Allowed users: {sorted(Config.ALLOWED_USERS)}")
     else:
         logger.warning("No ALLOWED_USERS set — anyone can message the bot!")
 
-    app = Application.builder().token(Config.TELEGRAM_BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(Config.TELEGRAM_BOT_TOKEN)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+        .build()
+    )
 
     # Store sender in bot_data so handlers can access it
     sender = MessageSender(app.bot)
@@ -394,5 +498,11 @@ def main():
 
 
 if __name__ == "__main__":
-    asyncio.set_event_loop(asyncio.new_event_loop())
+    # run_polling() picks up the current loop; use uvloop's when it's installed
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.set_event_loop(asyncio.new_event_loop())
+    else:
+        asyncio.set_event_loop(uvloop.new_event_loop())
     main()
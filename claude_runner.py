@@ -1,11 +1,17 @@
+import asyncio
+import functools
 import json
 import logging
 import os
-import queue
-import subprocess
-import threading
+from collections.abc import Callable
 from dataclasses import dataclass, field
 
+try:
+    import orjson
+    _json_loads = orjson.loads  # parses bytes directly; its errors subclass JSONDecodeError
+except ImportError:
+    _json_loads = json.loads
+
 logger = logging.getLogger("phone-bridge.claude")
 
 
@@ -27,76 +33,76 @@ class ClaudeResult:
     tool_calls: list[str] = field(default_factory=list)
 
 
+@functools.lru_cache(maxsize=256)
+def _basename(path: str) -> str:
+    # Claude tends to touch the same handful of files over and over
+    return os.path.basename(path)
+
+
+_TOOL_FORMATTERS: dict[str, Callable[[dict], str]] = {
+    "Read": lambda d: f"Reading {_basename(d.get('file_path', '?'))}",
+    "Write": lambda d: f"Writing {_basename(d.get('file_path', '?'))}",
+    "Edit": lambda d: f"Editing {_basename(d.get('file_path', '?'))}",
+    "Bash": lambda d: f"Running: {d.get('command', '?')[:60]}",
+    "Glob": lambda d: f"Finding files: {d.get('pattern', '?')}",
+    "Grep": lambda d: f"Searching: {d.get('pattern', '?')[:40]}",
+    "WebSearch": lambda d: f"Web search: {d.get('query', '?')[:50]}",
+    "WebFetch": lambda d: f"Fetching: {d.get('url', '?')[:50]}",
+    "NotebookEdit": lambda d: f"Editing notebook: {_basename(d.get('notebook_path', '?'))}",
+    "Task": lambda d: f"Agent: {d.get('description', d.get('prompt', '?')[:40])}",
+    "TaskOutput": lambda d: "Checking agent output",
+    "TaskStop": lambda d: "Stopping agent",
+    "ToolSearch": lambda d: f"Searching tools: {d.get('query', '?')[:40]}",
+    "TodoWrite": lambda d: "Updating todo list",
+}
+
+_CHROME_PREFIX = "mcp__claude-in-chrome__"
+# Keyed by the action after the last "__"; anything else shows as "Chrome: <action>"
+_CHROME_FORMATTERS: dict[str, Callable[[dict], str]] = {
+    "computer": lambda d: f"Chrome: {d.get('action', '?')}",
+    "navigate": lambda d: f"Chrome: navigating to {d.get('url', '?')[:40]}",
+    "read_page": lambda d: "Chrome: reading page",
+    "find": lambda d: f"Chrome: finding {d.get('query', '?')[:40]}",
+    "javascript_tool": lambda d: "Chrome: running JS",
+    "form_input": lambda d: "Chrome: filling form",
+    "tabs_context_mcp": lambda d: "Chrome: getting tabs",
+    "tabs_create_mcp": lambda d: "Chrome: new tab",
+    "get_page_text": lambda d: "Chrome: extracting text",
+}
+
+
 def _summarize_tool(name: str, input_data: dict) -> str:
     """Create a concise one-line summary of a tool call."""
-    match name:
-        case "Read":
-            path = input_data.get("file_path", "?")
-            return f"Reading {os.path.basename(path)}"
-        case "Write":
-            path = input_data.get("file_path", "?")
-            return f"Writing {os.path.basename(path)}"
-        case "Edit":
-            path = input_data.get("file_path", "?")
-            return f"Editing {os.path.basename(path)}"
-        case "Bash":
-            cmd = input_data.get("command", "?")
-            return f"Running: {cmd[:60]}"
-        case "Glob":
-            pattern = input_data.get("pattern", "?")
-            return f"Finding files: {pattern}"
-        case "Grep":
-            pattern = input_data.get("pattern", "?")
-            return f"Searching: {pattern[:40]}"
-        case "WebSearch":
-            q = input_data.get("query", "?")
-            return f"Web search: {q[:50]}"
-        case "WebFetch":
-            url = input_data.get("url", "?")
-            return f"Fetching: {url[:50]}"
-        case "NotebookEdit":
-            path = input_data.get("notebook_path", "?")
-            return f"Editing notebook: {os.path.basename(path)}"
-        case "Task":
-            desc = input_data.get("description", input_data.get("prompt", "?")[:40])
-            return f"Agent: {desc}"
-        case "TaskOutput":
-            return "Checking agent output"
-        case "TaskStop":
-            return "Stopping agent"
-        case "ToolSearch":
-            q = input_data.get("query", "?")
-            return f"Searching tools: {q[:40]}"
-        case "TodoWrite":
-            return "Updating todo list"
-        case name if name.startswith("mcp__claude-in-chrome__"):
-            action = name.split("__")[-1]
-            match action:
-                case "computer":
-                    act = input_data.get("action", "?")
-                    return f"Chrome: {act}"
-                case "navigate":
-                    url = input_data.get("url", "?")
-                    return f"Chrome: navigating to {url[:40]}"
-                case "read_page":
-                    return "Chrome: reading page"
-                case "find":
-                    q = input_data.get("query", "?")
-                    return f"Chrome: finding {q[:40]}"
-                case "javascript_tool":
-                    return "Chrome: running JS"
-                case "form_input":
-                    return "Chrome: filling form"
-                case "tabs_context_mcp":
-                    return "Chrome: getting tabs"
-                case "tabs_create_mcp":
-                    return "Chrome: new tab"
-                case "get_page_text":
-                    return "Chrome: extracting text"
-                case _:
-                    return f"Chrome: {action}"
-        case _:
-            return f"{name}"
+    fmt = _TOOL_FORMATTERS.get(name)
+    if fmt:
+        return fmt(input_data)
+    if name.startswith(_CHROME_PREFIX):
+        action = name.split("__")[-1]
+        fmt = _CHROME_FORMATTERS.get(action)
+        return fmt(input_data) if fmt else f"Chrome: {action}"
+    return name
+
+
+# stream-json lines for tool results echo whole files and command output, and
+# nothing here reads them. The CLI writes "type" first, so they can be skipped
+# before paying for json.loads.
+_TOOL_RESULT_PREFIX = b'{"type":"user"'
+
+# Per-line read buffer for claude's stdout. asyncio's 64 KiB default is too small
+# for events that carry whole file contents (Write inputs, long results).
+_STREAM_LIMIT = 4 * 1024 * 1024
+
+
+async def _discard_line(reader: asyncio.StreamReader):
+    """Consume the rest of an over-long line without buffering it whole."""
+    while True:
+        try:
+            await reader.readuntil(b"\n")
+            return
+        except asyncio.LimitOverrunError as e:
+            await reader.readexactly(e.consumed)
+        except asyncio.IncompleteReadError:
+            return
 
 
 SAFETY_PROMPT = """IMPORTANT RULES:
@@ -118,57 +124,78 @@ class ClaudeRunner:
         self.working_dir = working_dir
         self.allowed_tools = allowed_tools
         self.max_budget_usd = max_budget_usd
-        self.system_prompt = system_prompt
-        self.chrome_enabled = False
-        self._active_proc: subprocess.Popen | None = None
-        self._proc_lock = threading.Lock()
+        self._system_prompt = system_prompt
+        self._chrome_enabled = False
+        self._static_args: list[str] | None = None
+        self._active_proc: asyncio.subprocess.Process | None = None
 
-    def cancel(self) -> bool:
-        """Kill the active Claude process. Returns True if a process was killed."""
-        with self._proc_lock:
-            proc = self._active_proc
-            if proc and proc.poll() is None:
-                proc.kill()
-                logger.info("Cancelled active Claude process")
-                return True
-        return False
+    @property
+    def system_prompt(self) -> str:
+        return self._system_prompt
 
-    def _build_cmd(self, prompt: str, session_id: str | None, file_paths: list[str] | None, streaming: bool) -> list[str]:
-        fmt = "stream-json" if streaming else "json"
-        cmd = ["claude", "-p", prompt, "--output-format", fmt, "--verbose"]
+    @system_prompt.setter
+    def system_prompt(self, value: str):
+        self._system_prompt = value
+        self._static_args = None
 
-        if self.chrome_enabled:
-            cmd.append("--chrome")
+    @property
+    def chrome_enabled(self) -> bool:
+        return self._chrome_enabled
 
-        if file_paths:
-            for path in file_paths:
-                cmd.extend(["--add-dir", os.path.dirname(path)])
+    @chrome_enabled.setter
+    def chrome_enabled(self, value: bool):
+        self._chrome_enabled = value
+        self._static_args = None
 
-        if session_id:
-            cmd.extend(["--resume", session_id])
+    def cancel(self) -> bool:
+        """Kill the active Claude process. Returns True if a process was killed."""
+        proc = self._active_proc
+        if proc and proc.returncode is None:
+            proc.kill()
+            logger.info("Cancelled active Claude process")
+            return True
+        return False
 
-        if self.allowed_tools:
-            cmd.extend(["--allowedTools", self.allowed_tools])
+    def _get_static_args(self) -> list[str]:
+        """Arguments that don't change between messages; rebuilt only when settings change."""
+        if self._static_args is None:
+            args = []
+            if self.chrome_enabled:
+                args.append("--chrome")
 
-        if self.max_budget_usd > 0:
-            cmd.extend(["--max-budget-usd", str(self.max_budget_usd)])
+            if self.allowed_tools:
+                args.extend(["--allowedTools", self.allowed_tools])
 
-        # Always include safety prompt; append user prompt if set
-        full_prompt = SAFETY_PROMPT
-        if self.system_prompt:
-            full_prompt += f"\n\n{self.system_prompt}"
-        cmd.extend(["--append-system-prompt", full_prompt])
+            if self.max_budget_usd > 0:
+                args.extend(["--max-budget-usd", str(self.max_budget_usd)])
 
-        return cmd
+            # Always include safety prompt; append user prompt if set
+            full_prompt = SAFETY_PROMPT
+            if self.system_prompt:
+                full_prompt += f"\n\n{self.system_prompt}"
+            args.extend(["--append-system-prompt", full_prompt])
+            self._static_args = args
+        return self._static_args
 
-    def run_streaming(
+    def _build_cmd(self, prompt: str, session_id: str | None, file_paths: list[str] | None, streaming: bool) -> list[str]:
+        fmt = "stream-json" if streaming else "json"
+        # One --add-dir per distinct directory, in first-seen order
+        dirs = dict.fromkeys(os.path.dirname(path) or "." for path in file_paths or ())
+        return [
+            "claude", "-p", prompt, "--output-format", fmt, "--verbose",
+            *(arg for directory in dirs for arg in ("--add-dir", directory)),
+            *(("--resume", session_id) if session_id else ()),
+            *self._get_static_args(),
+        ]
+
+    async def run_streaming(
         self,
         prompt: str,
         session_id: str | None = None,
         file_paths: list[str] | None = None,
-        event_queue: queue.Queue | None = None,
+        on_tool: Callable[[ToolEvent], None] | None = None,
     ) -> ClaudeResult:
-        """Run claude with stream-json, emitting ToolEvents to event_queue as they happen."""
+        """Run claude with stream-json, passing each ToolEvent to on_tool as it happens."""
         cmd = self._build_cmd(prompt, session_id, file_paths, streaming=True)
         logger.info(f"Running claude (streaming) in {self.working_dir} (session={session_id or 'new'})")
 
@@ -176,36 +203,41 @@ class ClaudeRunner:
         result_obj = None
         final_session_id = session_id or ""
         stderr_output = ""
+        proc = None
 
         try:
-            proc = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
+            proc = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
                 cwd=self.working_dir,
-                env={**os.environ},
+                limit=_STREAM_LIMIT,
             )
+            self._active_proc = proc
 
-            with self._proc_lock:
-                self._active_proc = proc
-
-            # Read stderr in background thread so it doesn't block
-            stderr_parts = []
-            def read_stderr():
-                for line in proc.stderr:
-                    stderr_parts.append(line)
-            stderr_thread = threading.Thread(target=read_stderr, daemon=True)
-            stderr_thread.start()
+            # Drain stderr alongside stdout so a full pipe can't stall the child
+            stderr_task = asyncio.create_task(proc.stderr.read())
 
             # Read stdout line by line
-            for line in proc.stdout:
+            while True:
+                try:
+                    line = await proc.stdout.readuntil(b"\n")
+                except asyncio.IncompleteReadError as e:
+                    if not e.partial:
+                        break
+                    line = e.partial  # last line had no trailing newline
+                except asyncio.LimitOverrunError:
+                    # An event bigger than _STREAM_LIMIT: drop it rather than the whole run
+                    logger.warning(f"Skipping claude output line over {_STREAM_LIMIT} bytes")
+                    await _discard_line(proc.stdout)
+                    continue
+
                 line = line.strip()
-                if not line:
+                if not line or line.startswith(_TOOL_RESULT_PREFIX):
                     continue
 
                 try:
-                    event = json.loads(line)
+                    event = _json_loads(line)
                 except json.JSONDecodeError:
                     continue
 
@@ -222,16 +254,15 @@ class ClaudeRunner:
                             input_data = block.get("input", {})
                             summary = _summarize_tool(name, input_data)
                             tool_calls.append(summary)
-                            if event_queue:
-                                event_queue.put(ToolEvent(name=name, summary=summary))
+                            if on_tool:
+                                on_tool(ToolEvent(name=name, summary=summary))
 
                 elif event_type == "result":
                     result_obj = event
                     final_session_id = event.get("session_id", final_session_id)
 
-            proc.wait()
-            stderr_thread.join(timeout=5)
-            stderr_output = "".join(stderr_parts)
+            await proc.wait()
+            stderr_output = (await stderr_task).decode(errors="replace")
 
         except Exception as e:
             logger.exception("Error running claude")
@@ -242,8 +273,10 @@ class ClaudeRunner:
                 tool_calls=tool_calls,
             )
         finally:
-            with self._proc_lock:
-                self._active_proc = None
+            self._active_proc = None
+            # Don't leave claude running if we bailed out early or were cancelled
+            if proc is not None and proc.returncode is None:
+                proc.kill()
 
         if proc.returncode != 0:
             # -9 (SIGKILL) means we cancelled it via /timeout
@@ -288,6 +321,6 @@ class ClaudeRunner:
             tool_calls=tool_calls,
         )
 
-    def run(self, prompt: str, session_id: str | None = None, file_paths: list[str] | None = None) -> ClaudeResult:
+    async def run(self, prompt: str, session_id: str | None = None, file_paths: list[str] | None = None) -> ClaudeResult:
         """Non-streaming fallback."""
-        return self.run_streaming(prompt, session_id, file_paths)
+        return await self.run_streaming(prompt, session_id, file_paths)
@@ -11,15 +11,16 @@ class Config:
     TELEGRAM_BOT_TOKEN: str = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 
     # Security: allowed Telegram user IDs
-    ALLOWED_USERS: list[int] = [
+    ALLOWED_USERS: frozenset[int] = frozenset(
         int(u.strip()) for u in os.environ.get("ALLOWED_USERS", "").split(",") if u.strip()
-    ]
+    )
 
     # Claude
     CLAUDE_WORKING_DIR: str = os.environ.get("CLAUDE_WORKING_DIR", os.path.expanduser("~"))
     CLAUDE_ALLOWED_TOOLS: str = os.environ.get("CLAUDE_ALLOWED_TOOLS", "Read,Write,Edit,Bash,Glob,Grep,WebSearch,WebFetch,NotebookEdit,Task,TaskOutput,TaskStop,ToolSearch,TodoWrite")
     CLAUDE_MAX_BUDGET_USD: float = float(os.environ.get("CLAUDE_MAX_BUDGET_USD", "5.00"))
     CLAUDE_SYSTEM_PROMPT: str = os.environ.get("CLAUDE_SYSTEM_PROMPT", "")
+    MAX_CONCURRENT_CLAUDE: int = int(os.environ.get("MAX_CONCURRENT_CLAUDE", "4"))
 
     # Outbox for sending files back to the user
     OUTBOX_DIR: str = os.path.join(os.environ.get("CLAUDE_WORKING_DIR", os.path.expanduser("~/claude_stuff")), "outbox")
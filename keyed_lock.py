@@ -0,0 +1,61 @@
+import asyncio
+from collections.abc import Hashable
+
+
+class KeyedLockPool:
+    """Per-key asyncio locks that are recycled once nobody holds or waits on them.
+
+    Entries are refcounted, so the table only holds keys that are currently
+    in use and memory stays bounded no matter how many distinct keys are seen.
+    Released locks go back to a small free-list for reuse. All bookkeeping
+    happens synchronously on the event loop, so no extra guard is needed.
+    """
+
+    def __init__(self, prealloc: int = 8):
+        self._entries: dict[Hashable, list] = {}  # key -> [lock, refcount]
+        self._max_free = prealloc
+        self._free: list[asyncio.Lock] = [asyncio.Lock() for _ in range(prealloc)]
+
+    def lock(self, key: Hashable) -> "_KeyedLock":
+        """Return an async context manager that holds the lock for `key`."""
+        return _KeyedLock(self, key)
+
+    def _checkout(self, key: Hashable) -> asyncio.Lock:
+        entry = self._entries.get(key)
+        if entry is None:
+            lock = self._free.pop() if self._free else asyncio.Lock()
+            entry = self._entries[key] = [lock, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _checkin(self, key: Hashable):
+        entry = self._entries[key]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del self._entries[key]
+            if len(self._free) < self._max_free:
+                self._free.append(entry[0])
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class _KeyedLock:
+    __slots__ = ("_pool", "_key", "_lock")
+
+    def __init__(self, pool: KeyedLockPool, key: Hashable):
+        self._pool = pool
+        self._key = key
+        self._lock: asyncio.Lock | None = None
+
+    async def __aenter__(self):
+        self._lock = self._pool._checkout(self._key)
+        try:
+            await self._lock.acquire()
+        except BaseException:
+            self._pool._checkin(self._key)
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self._lock.release()
+        self._pool._checkin(self._key)
@@ -1,14 +1,90 @@
+import collections
 import html
 import logging
 import re
+from typing import TYPE_CHECKING
 
-from telegram import Bot
-from telegram.constants import MessageLimit
+if TYPE_CHECKING:
+    from telegram import Bot
 
 logger = logging.getLogger("phone-bridge.sender")
 
-TELEGRAM_MAX = MessageLimit.MAX_TEXT_LENGTH  # 4096
+TELEGRAM_MAX = 4096  # telegram.constants.MessageLimit.MAX_TEXT_LENGTH
 TRUNCATE_THRESHOLD = 16000
+_TRUNCATED_NOTE = "\n\n[Truncated — send /more for the rest]"
+# Room kept for the "[i/N] " numbering on split replies (fits up to 99 parts)
+_PART_PREFIX_RESERVE = len("[99/99] ")
+
+
+_FENCE_SPLIT = re.compile(r"(```(?:\w*)\n[\s\S]*?```)")
+_FENCE_MATCH = re.compile(r"```(\w*)\n([\s\S]*?)```")
+# Inline Markdown delimiters; the scanner jumps between these and copies everything else
+_MARKER = re.compile(r"[`*_~]")
+_DOUBLE_TAGS = {"*": "b", "_": "b", "~": "s"}
+
+
+def _is_word(ch: str) -> bool:
+    return ch.isalnum() or ch == "_"
+
+
+def _md_inline_to_html(s: str) -> str:
+    """Render inline code, bold, italic and strikethrough in a single left-to-right pass.
+
+    `s` must already be HTML-escaped. Emphasis stays within one line; inline code
+    may span lines. Emphasis content is rendered recursively so it can nest.
+    """
+    out: list[str] = []
+    n = len(s)
+    start = 0  # beginning of the literal run not yet copied to out
+    # marker -> position before which an opener is known to have no closer
+    dead: dict[str, int] = {}
+    line_end = -1  # end of the line holding the current marker
+
+    m = _MARKER.search(s)
+    while m:
+        j = m.start()
+        c = s[j]
+        if j > line_end:
+            line_end = s.find("\n", j)
+            if line_end == -1:
+                line_end = n
+        rendered = None
+
+        if c == "`":
+            close = s.find("`", j + 1) if dead.get(c, -1) <= j else -1
+            if close == -1:
+                dead[c] = n
+            elif close > j + 1:
+                rendered, end = f"<code>{s[j + 1:close]}</code>", close + 1
+        elif s.startswith(c + c, j):
+            key = c + c
+            close = s.find(key, j + 3, line_end) if dead.get(key, -1) <= j else -1
+            if close == -1:
+                dead[key] = line_end
+            else:
+                tag = _DOUBLE_TAGS[c]
+                rendered, end = f"<{tag}>{_md_inline_to_html(s[j + 2:close])}</{tag}>", close + 2
+        elif c != "~" and (j == 0 or not _is_word(s[j - 1])) and dead.get(c, -1) <= j:
+            # Single * or _: the closer can't touch another marker or a word character
+            pos = j + 2
+            while (k := s.find(c, pos, line_end)) != -1:
+                if s[k - 1] != c and (k + 1 == n or (s[k + 1] != c and not _is_word(s[k + 1]))):
+                    rendered, end = f"<i>{_md_inline_to_html(s[j + 1:k])}</i>", k + 1
+                    break
+                pos = k + 1
+            else:
+                dead[c] = line_end
+
+        if rendered is None:
+            m = _MARKER.search(s, j + 1)
+            continue
+        out.append(s[start:j])
+        out.append(rendered)
+        start = end
+        m = _MARKER.search(s, end)
+
+    out.append(s[start:])
+    return "".join(out)
 
 
 def markdown_to_telegram_html(text: str) -> str:
@@ -17,12 +93,16 @@ def markdown_to_telegram_html(text: str) -> str:
     Handles fenced code blocks, inline code, bold, italic, and strikethrough.
     Anything not inside a code block gets HTML-escaped first so raw < > & are safe.
     """
+    # Plain replies ("Done.", "Yes") have nothing to render
+    if not any(c in text for c in "`*_~"):
+        return html.escape(text)
+
     parts: list[str] = []
     # Split on fenced code blocks (``` ... ```)
-    segments = re.split(r"(```(?:\w*)\n[\s\S]*?```)", text)
+    segments = _FENCE_SPLIT.split(text)
 
     for segment in segments:
-        m = re.match(r"```(\w*)\n([\s\S]*?)```", segment)
+        m = _FENCE_MATCH.match(segment)
         if m:
             lang = m.group(1)
             code = html.escape(m.group(2).rstrip("\n"))
@@ -31,27 +111,17 @@ def markdown_to_telegram_html(text: str) -> str:
             else:
                 parts.append(f"<pre>{code}</pre>")
         else:
-            # Escape HTML entities first
-            s = html.escape(segment)
-            # Inline code
-            s = re.sub(r"`([^`]+)`", r"<code>\1</code>", s)
-            # Bold (**text** or __text__)
-            s = re.sub(r"\*\*(.+?)\*\*", r"<b>\1</b>", s)
-            s = re.sub(r"__(.+?)__", r"<b>\1</b>", s)
-            # Italic (*text* or _text_) — careful not to match inside words with underscores
-            s = re.sub(r"(?<!\w)\*(?!\*)(.+?)(?<!\*)\*(?!\w)", r"<i>\1</i>", s)
-            s = re.sub(r"(?<!\w)_(?!_)(.+?)(?<!_)_(?!\w)", r"<i>\1</i>", s)
-            # Strikethrough
-            s = re.sub(r"~~(.+?)~~", r"<s>\1</s>", s)
-            parts.append(s)
+            # Escape HTML entities first, then render inline markup
+            parts.append(_md_inline_to_html(html.escape(segment)))
 
     return "".join(parts)
 
 
 class MessageSender:
-    def __init__(self, bot: Bot):
+    def __init__(self, bot: "Bot"):
         self.bot = bot
-        self._overflow: dict[int, str] = {}
+        # Remaining /more batches per chat, cut once when the reply is first sent
+        self._overflow: dict[int, collections.deque[str]] = {}
 
     async def send(self, chat_id: int, text: str):
         """Send a message, splitting or truncating if needed.
@@ -59,23 +129,33 @@ class MessageSender:
         Converts Markdown to Telegram HTML. Falls back to plain text if
         Telegram rejects the markup.
         """
-        chunks = self._prepare_chunks(chat_id, text)
+        await self._send_chunks(chat_id, self._prepare_chunks(chat_id, text))
+
+    async def _send_chunks(self, chat_id: int, chunks: list[str]):
+        # One at a time: Telegram orders messages by arrival, so each part
+        # (including any plain-text retry) must land before the next starts
         for chunk in chunks:
-            html_chunk = markdown_to_telegram_html(chunk)
-            try:
-                await self.bot.send_message(
-                    chat_id=chat_id, text=html_chunk, parse_mode="HTML",
-                )
-            except Exception:
-                # Fallback: send as plain text if HTML parsing fails
-                await self.bot.send_message(chat_id=chat_id, text=chunk)
+            await self._send_chunk(chat_id, chunk)
+
+    async def _send_chunk(self, chat_id: int, chunk: str):
+        html_chunk = markdown_to_telegram_html(chunk)
+        try:
+            await self.bot.send_message(
+                chat_id=chat_id, text=html_chunk, parse_mode="HTML",
+            )
+        except Exception:
+            # Fallback: send as plain text if HTML parsing fails
+            await self.bot.send_message(chat_id=chat_id, text=chunk)
 
     async def send_more(self, chat_id: int) -> bool:
         """Send the next batch of overflow text."""
-        overflow = self._overflow.pop(chat_id, None)
-        if not overflow:
+        batches = self._overflow.get(chat_id)
+        if not batches:
             return False
-        await self.send(chat_id, overflow)
+        batch = batches.popleft()
+        if not batches:
+            del self._overflow[chat_id]
+        await self._send_chunks(chat_id, self._split(batch))
         return True
 
     def has_overflow(self, chat_id: int) -> bool:
@@ -86,37 +166,56 @@ class MessageSender:
             return [text]
 
         if len(text) > TRUNCATE_THRESHOLD:
-            cut = self._find_break(text, TRUNCATE_THRESHOLD)
-            self._overflow[chat_id] = text[cut:]
-            text = text[:cut].rstrip() + "\n\n[Truncated — send /more for the rest]"
+            batches = self._batch(text)
+            text = batches.popleft()
+            self._overflow[chat_id] = batches
 
         return self._split(text)
 
+    def _batch(self, text: str) -> collections.deque[str]:
+        """Cut text into TRUNCATE_THRESHOLD-sized batches, one per /more."""
+        batches: collections.deque[str] = collections.deque()
+        n = len(text)
+        pos = 0
+        while n - pos > TRUNCATE_THRESHOLD:
+            cut = self._find_break(text, pos, pos + TRUNCATE_THRESHOLD)
+            batches.append(text[pos:cut].rstrip() + _TRUNCATED_NOTE)
+            pos = cut
+        batches.append(text[pos:])
+        return batches
+
     def _split(self, text: str) -> list[str]:
         if len(text) <= TELEGRAM_MAX:
             return [text]
 
         chunks: list[str] = []
-        remaining = text
-
-        while remaining:
-            if len(remaining) <= TELEGRAM_MAX:
-                chunks.append(remaining)
-                break
-
-            cut = self._find_break(remaining, TELEGRAM_MAX)
-            chunks.append(remaining[:cut].rstrip())
-            remaining = remaining[cut:].lstrip()
+        n = len(text)
+        pos = 0
+        # Leave room for the "[i/N] " prefix added below
+        limit = TELEGRAM_MAX - _PART_PREFIX_RESERVE
+
+        # Walk an index through the text instead of re-slicing the remainder each time
+        while n - pos > limit:
+            cut = self._find_break(text, pos, pos + limit)
+            chunks.append(text[pos:cut].rstrip())
+            pos = cut
+            while pos < n and text[pos].isspace():
+                pos += 1
+        if pos < n:
+            chunks.append(text[pos:])
 
         if len(chunks) > 1:
             total = len(chunks)
-            chunks = [f"[{i + 1}/{total}] {chunk}" for i, chunk in enumerate(chunks)]
+            for i in range(total):
+                chunks[i] = f"[{i + 1}/{total}] {chunks[i]}"
 
         return chunks
 
-    def _find_break(self, text: str, max_pos: int) -> int:
+    def _find_break(self, text: str, start: int, max_pos: int) -> int:
+        """Find a natural break in text[start:max_pos], preferring its second half."""
+        half = start + (max_pos - start) // 2
         for delimiter in ["\n\n", "\n", ". ", " "]:
-            pos = text.rfind(delimiter, 0, max_pos)
-            if pos > max_pos // 2:
+            pos = text.rfind(delimiter, start, max_pos)
+            if pos > half:
                 return pos + len(delimiter)
         return max_pos
@@ -1,83 +1,305 @@
+import asyncio
 import sqlite3
-from datetime import datetime, timezone
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import NamedTuple
+
+
+# Bump when adding a step to SessionStore._migrate
+_SCHEMA_VERSION = 2
+
+# Read-through cache for get_session/get_cost; writes through this store invalidate it
+CACHE_TTL = 60.0
+CACHE_MAXSIZE = 4096
+
+# Current UTC time in the same ISO-8601 shape as datetime.isoformat() (millisecond precision)
+_SQL_NOW = "strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')"
+
+# Statements are kept as constants so each connection's statement cache reuses them
+# Touch last_used_at and read the id in one statement (needs SQLite 3.35+)
+_SQL_GET = f"UPDATE sessions SET last_used_at = {_SQL_NOW} WHERE phone_number = ? RETURNING session_id"
+_SQL_UPSERT = f"""
+    INSERT INTO sessions (phone_number, session_id, working_dir, created_at, last_used_at, message_count, total_cost_usd)
+    VALUES (?, ?, ?, {_SQL_NOW}, {_SQL_NOW}, 1, ?)
+    ON CONFLICT(phone_number) DO UPDATE SET
+        session_id = excluded.session_id,
+        last_used_at = excluded.last_used_at,
+        message_count = message_count + 1,
+        total_cost_usd = sessions.total_cost_usd + excluded.total_cost_usd
+"""
+# The planner prefers the unique primary-key index, which still reads the row; pin the covering one
+_SQL_COST = "SELECT total_cost_usd FROM sessions INDEXED BY idx_sessions_phone_cost WHERE phone_number = ?"
+_SQL_INFO = """
+    SELECT session_id, message_count, last_used_at, total_cost_usd
+    FROM sessions WHERE phone_number = ? LIMIT 1
+"""
+_SQL_DELETE = "DELETE FROM sessions WHERE phone_number = ?"
+_SQL_LIST = """
+    SELECT phone_number, session_id, working_dir, created_at, last_used_at, message_count, total_cost_usd
+    FROM sessions ORDER BY last_used_at DESC LIMIT ? OFFSET ?
+"""
+# Answered from idx_sessions_recent alone, without reading table rows
+_SQL_LIST_SUMMARIES = """
+    SELECT phone_number, last_used_at, message_count
+    FROM sessions ORDER BY last_used_at DESC LIMIT ? OFFSET ?
+"""
+
+
+class Session(NamedTuple):
+    """One row of the sessions table, in column order."""
+    phone_number: str
+    session_id: str
+    working_dir: str
+    created_at: str
+    last_used_at: str
+    message_count: int
+    total_cost_usd: float
+
+
+class SessionSummary(NamedTuple):
+    """The narrow per-session view returned by list_session_summaries."""
+    phone_number: str
+    last_used_at: str
+    message_count: int
+
+
+_MISS = object()
+
+
+class _TTLCache:
+    """Small thread-safe dict cache whose entries expire after `ttl` seconds.
+
+    Past `maxsize`, the entry written longest ago is evicted first.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._data: dict = {}  # key -> (expires_at, value), in write order
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return _MISS
+            if entry[0] < time.monotonic():
+                del self._data[key]
+                return _MISS
+            return entry[1]
+
+    def set(self, key, value):
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.monotonic() + self._ttl, value)
+            if len(self._data) > self._maxsize:
+                del self._data[next(iter(self._data))]
+
+    def pop(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
 
 
 class SessionStore:
     def __init__(self, db_path: str):
         self.db_path = db_path
+        self._local = threading.local()
+        # The a*() methods run here: one thread, so one connection and serialized writes
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="session-store")
+        self._session_cache = _TTLCache(CACHE_MAXSIZE, CACHE_TTL)
+        self._cost_cache = _TTLCache(CACHE_MAXSIZE, CACHE_TTL)
         self._init_db()
 
     def _connect(self) -> sqlite3.Connection:
-        return sqlite3.connect(self.db_path)
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit: each statement commits on its own, without Python's implicit BEGIN
+            conn = sqlite3.connect(self.db_path, isolation_level=None, cached_statements=256)
+            # Per-connection settings; journal_mode is persisted in the file by _init_db
+            conn.executescript(
+                "PRAGMA synchronous=NORMAL; PRAGMA temp_store=MEMORY; PRAGMA cache_size=-64000;"
+                " PRAGMA mmap_size=268435456; PRAGMA busy_timeout=5000; PRAGMA wal_autocheckpoint=1000;"
+            )
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def transaction(self):
+        """Group writes into one commit; `with store.transaction(): store.save_session(...)`.
+
+        Other methods called inside the block use the same thread-local connection,
+        so they join the transaction. Nested blocks fold into the outermost one.
+        """
+        conn = self._connect()
+        if conn.in_transaction:
+            yield conn
+            return
+        # IMMEDIATE takes the write lock up front instead of upgrading mid-transaction
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+        # Other threads may have cached rows this transaction changed
+        self._invalidate()
+
+    def maintenance(self):
+        """Checkpoint and truncate the WAL, then refresh planner stats. Call periodically.
+
+        Autocheckpoints can't finish while a reader is open, so a long-running
+        process can otherwise let the -wal file grow without bound.
+        """
+        conn = self._connect()
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        conn.execute("PRAGMA optimize")
 
     def _init_db(self):
-        with self._connect() as conn:
-            conn.execute("""
-                CREATE TABLE IF NOT EXISTS sessions (
-                    phone_number TEXT PRIMARY KEY,
-                    session_id TEXT NOT NULL,
-                    working_dir TEXT NOT NULL,
-                    created_at TEXT DEFAULT (datetime('now')),
-                    last_used_at TEXT DEFAULT (datetime('now')),
-                    message_count INTEGER DEFAULT 0,
-                    total_cost_usd REAL DEFAULT 0.0
-                )
-            """)
-            # Migrate existing tables that lack the cost column
-            try:
+        conn = self._connect()
+        # WAL lets readers proceed while a write is in flight
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS sessions (
+                phone_number TEXT PRIMARY KEY,
+                session_id TEXT NOT NULL,
+                working_dir TEXT NOT NULL,
+                created_at TEXT DEFAULT (datetime('now')),
+                last_used_at TEXT DEFAULT (datetime('now')),
+                message_count INTEGER DEFAULT 0,
+                total_cost_usd REAL DEFAULT 0.0
+            )
+        """)
+        self._migrate(conn)
+        # Lets list_sessions walk rows already in ORDER BY last_used_at DESC order, and
+        # covers every column list_session_summaries reads
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sessions_recent"
+            " ON sessions(last_used_at DESC, phone_number, message_count)"
+        )
+        # Lets get_cost read total_cost_usd from the index without touching the table row
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_sessions_phone_cost ON sessions(phone_number, total_cost_usd)"
+        )
+
+    def _migrate(self, conn: sqlite3.Connection):
+        """Bring an existing database up to _SCHEMA_VERSION, tracked in PRAGMA user_version."""
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= _SCHEMA_VERSION:
+            return
+        if version < 1:
+            # Tables created before cost tracking lack total_cost_usd
+            cols = {row[1] for row in conn.execute("PRAGMA table_info(sessions)")}
+            if "total_cost_usd" not in cols:
                 conn.execute("ALTER TABLE sessions ADD COLUMN total_cost_usd REAL DEFAULT 0.0")
-            except Exception:
-                pass  # Column already exists
+        if version < 2:
+            # Superseded by the covering idx_sessions_recent
+            conn.execute("DROP INDEX IF EXISTS idx_sessions_last_used")
+        conn.execute(f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    def _invalidate(self, phone_number: str | None = None):
+        """Drop cached reads for one phone number, or for everyone."""
+        if phone_number is None:
+            self._session_cache.clear()
+            self._cost_cache.clear()
+        else:
+            self._session_cache.pop(phone_number)
+            self._cost_cache.pop(phone_number)
 
     def get_session(self, phone_number: str) -> str | None:
-        """Return session_id for phone, or None if no session exists."""
-        with self._connect() as conn:
-            row = conn.execute(
-                "SELECT session_id FROM sessions WHERE phone_number = ?",
-                (phone_number,),
-            ).fetchone()
-            if row:
-                conn.execute(
-                    "UPDATE sessions SET last_used_at = ? WHERE phone_number = ?",
-                    (datetime.now(timezone.utc).isoformat(), phone_number),
-                )
-                return row[0]
-            return None
+        """Return session_id for phone, or None if no session exists.
+
+        A cache hit skips the last_used_at touch; save_session refreshes it after each run.
+        """
+        session_id = self._session_cache.get(phone_number)
+        if session_id is not _MISS:
+            return session_id
+        conn = self._connect()
+        row = conn.execute(_SQL_GET, (phone_number,)).fetchone()
+        session_id = row[0] if row else None
+        if not conn.in_transaction:
+            self._session_cache.set(phone_number, session_id)
+        return session_id
 
     def save_session(self, phone_number: str, session_id: str, working_dir: str, cost_usd: float = 0.0):
         """Upsert session_id for phone number, accumulating cost."""
-        now = datetime.now(timezone.utc).isoformat()
-        with self._connect() as conn:
-            conn.execute(
-                """
-                INSERT INTO sessions (phone_number, session_id, working_dir, created_at, last_used_at, message_count, total_cost_usd)
-                VALUES (?, ?, ?, ?, ?, 1, ?)
-                ON CONFLICT(phone_number) DO UPDATE SET
-                    session_id = excluded.session_id,
-                    last_used_at = excluded.last_used_at,
-                    message_count = message_count + 1,
-                    total_cost_usd = total_cost_usd + ?
-                """,
-                (phone_number, session_id, working_dir, now, now, cost_usd, cost_usd),
-            )
+        self._connect().execute(_SQL_UPSERT, (phone_number, session_id, working_dir, cost_usd))
+        self._invalidate(phone_number)
+
+    def save_sessions_bulk(self, items: list[tuple[str, str, str, float]]):
+        """Upsert many (phone_number, session_id, working_dir, cost_usd) rows in one transaction."""
+        with self.transaction() as conn:
+            # Rows already match the statement's parameters
+            conn.executemany(_SQL_UPSERT, items)
 
     def get_cost(self, phone_number: str) -> float:
         """Return cumulative cost for a user."""
-        with self._connect() as conn:
-            row = conn.execute(
-                "SELECT total_cost_usd FROM sessions WHERE phone_number = ?",
-                (phone_number,),
-            ).fetchone()
-            return row[0] if row else 0.0
+        cost = self._cost_cache.get(phone_number)
+        if cost is not _MISS:
+            return cost
+        conn = self._connect()
+        row = conn.execute(_SQL_COST, (phone_number,)).fetchone()
+        cost = row[0] if row else 0.0
+        if not conn.in_transaction:
+            self._cost_cache.set(phone_number, cost)
+        return cost
+
+    def get_session_info(self, phone_number: str) -> dict | None:
+        """Return stats for a single session, or None if no session exists."""
+        conn = self._connect()
+        cur = conn.cursor()
+        cur.row_factory = sqlite3.Row
+        row = cur.execute(_SQL_INFO, (phone_number,)).fetchone()
+        return dict(row) if row else None
 
     def reset_session(self, phone_number: str):
         """Delete session for phone number."""
-        with self._connect() as conn:
-            conn.execute("DELETE FROM sessions WHERE phone_number = ?", (phone_number,))
-
-    def list_sessions(self) -> list[dict]:
-        """Return all active sessions."""
-        with self._connect() as conn:
-            conn.row_factory = sqlite3.Row
-            rows = conn.execute("SELECT * FROM sessions ORDER BY last_used_at DESC").fetchall()
-            return [dict(row) for row in rows]
+        self._connect().execute(_SQL_DELETE, (phone_number,))
+        self._invalidate(phone_number)
+
+    def list_sessions(self, limit: int = 1000, offset: int = 0) -> list[Session]:
+        """Return active sessions, most recently used first, one page at a time."""
+        rows = self._connect().execute(_SQL_LIST, (limit, offset)).fetchall()
+        return [Session._make(row) for row in rows]
+
+    def list_session_summaries(self, limit: int = 1000, offset: int = 0) -> list[SessionSummary]:
+        """Like list_sessions, but only phone number, last use and message count."""
+        rows = self._connect().execute(_SQL_LIST_SUMMARIES, (limit, offset)).fetchall()
+        return [SessionSummary._make(row) for row in rows]
+
+    # Async variants for the event loop: same behavior, run on the store's worker thread
+
+    async def _offload(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def aget_session(self, phone_number: str) -> str | None:
+        # Cache hits don't need the worker thread
+        session_id = self._session_cache.get(phone_number)
+        if session_id is not _MISS:
+            return session_id
+        return await self._offload(self.get_session, phone_number)
+
+    async def asave_session(self, phone_number: str, session_id: str, working_dir: str, cost_usd: float = 0.0):
+        await self._offload(self.save_session, phone_number, session_id, working_dir, cost_usd)
+
+    async def aget_cost(self, phone_number: str) -> float:
+        cost = self._cost_cache.get(phone_number)
+        if cost is not _MISS:
+            return cost
+        return await self._offload(self.get_cost, phone_number)
+
+    async def aget_session_info(self, phone_number: str) -> dict | None:
+        return await self._offload(self.get_session_info, phone_number)
+
+    async def areset_session(self, phone_number: str):
+        await self._offload(self.reset_session, phone_number)
+
+    async def amaintenance(self):
+        await self._offload(self.maintenance)